@@ -9,14 +9,16 @@
 4. BERT (assembling all the components
 """
 
+import copy
 import math
 import re
-from random import *
 import numpy as np
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import torch.optim as optim
+import torch.ao.quantization as tq
 
 print("MODULES LOADED")
 
@@ -35,13 +37,16 @@ class EmbeddingLayer(nn.Module):
       self.position_embedding = nn.Embedding(maxlen,d_model)
       self.segment_embedding = nn.Embedding(n_segments,d_model)
       self.norm = nn.LayerNorm(d_model)
+      # positions are the same for every batch, build them once: (1,maxlen)
+      self.register_buffer("pos_ids", torch.arange(maxlen,dtype=torch.long).unsqueeze(0), persistent=False)
 
    def forward(self,x,seg):
-      seq_len = x.size(1)
-      pos = torch.arange(seq_len,dtype=torch.long)  
-      #(seq_len,) --> (batch_size,seq_len)
-      pos = pos.unsqueeze(0).expand_as(x)
-      embedding = self.token_embedding(x) + self.position_embedding(pos) + self.segment_embedding(seg)
+      #(1,maxlen) --> (batch_size,seq_len)
+      pos = self.pos_ids[:, :x.size(1)].expand(x.size(0), -1)
+      # in-place adds reuse the token embedding buffer instead of allocating a temporary per sum
+      embedding = self.token_embedding(x)
+      embedding += self.position_embedding(pos)
+      embedding += self.segment_embedding(seg)
       return self.norm(embedding)
 
 """Attention Mask
@@ -52,10 +57,8 @@ The length of the first sentence is equal to the length of the second sentence.
 """
 
 def get_attention_pad_mask(seq_q,seq_k):
-    batch_size,len_q = seq_q.size()
-    batch_size,len_k = seq_k.size()
-    pad_attn_mask = seq_k.data.eq(0).unsqueeze(1)  # batch_size x 1 x len_k(=len_q), one is masking
-    return pad_attn_mask.expand(batch_size, len_q, len_k)  # batch_size x len_q x len_k
+    # only the keys are masked, so the mask broadcasts over the heads and len_q(=seq_q.size(1)) as a pure view
+    return (seq_k == 0).unsqueeze(1).unsqueeze(1)  # batch_size x 1 x 1 x len_k, one is masking
 
 """Encoder Layer
 The encoder has two main components: 
@@ -70,8 +73,8 @@ class EncoderLayer(nn.Module):
       self.enc_self_attn = MultiHeadAttention()
       self.pos_ffn = PositionWiseFeedForward()
 
-   def forward(enc_inputs,enc_self_attn_mask):
-      enc_outputs, attn = self.enc_self_attn(enc_inputs, enc_inputs, enc_inputs, enc_self_attn_mask) # enc_inputs to same Q,K,V
+   def forward(self,enc_inputs,enc_self_attn_mask,need_weights=False):
+      enc_outputs, attn = self.enc_self_attn(enc_inputs, enc_inputs, enc_inputs, enc_self_attn_mask, need_weights) # enc_inputs to same Q,K,V
       enc_outputs = self.pos_ffn(enc_outputs) # enc_outputs: [batch_size x len_q x d_model]
       return enc_outputs, attn
 
@@ -88,8 +91,11 @@ class MultiHeadAttention(nn.Module):
       self.WQ = nn.Linear(d_model,d_k * n_heads)
       self.WK = nn.Linear(d_model,d_k * n_heads)
       self.WV = nn.Linear(d_model,d_v * n_heads)
+      self.attn = ScaledDotProductAttention()
+      self.proj = nn.Linear(n_heads * d_v, d_model)
+      self.ln = nn.LayerNorm(d_model)
 
-   def forward(self,Q,K,V,attn_mask):
+   def forward(self,Q,K,V,attn_mask,need_weights=False):
       # q: [batch_size x len_q x d_model], k: [batch_size x len_k x d_model], v: [batch_size x len_k x d_model]
       residual,batch_size = Q,Q.size(0)
       # (B, S, D) -proj-> (B, S, D) -split-> (B, S, H, W) -trans-> (B, H, S, W)
@@ -97,32 +103,39 @@ class MultiHeadAttention(nn.Module):
       k_s = self.WK(K).view(batch_size, -1, n_heads, d_k).transpose(1,2)  # k_s: [batch_size x n_heads x len_k x d_k]
       v_s = self.WV(V).view(batch_size, -1, n_heads, d_v).transpose(1,2)  # v_s: [batch_size x n_heads x len_k x d_v]
       
-      # attn_mask : [batch_size x n_heads x len_q x len_k]
-      attn_mask = attn_mask.unsqueeze(1).repeat(1,n_heads,1,1)
-
-      # context: [batch_size x n_heads x len_q x d_v], attn: [batch_size x n_heads x len_q(=len_k) x len_k(=len_q)]
-      context, attn = ScaledDotProductAttention()(q_s, k_s, v_s, attn_mask)
+      # attn_mask : additive [batch_size x 1 x 1 x len_k], broadcast over the heads and len_q
+      if need_weights:
+         # eager path, only needed to inspect attn: [batch_size x n_heads x len_q(=len_k) x len_k(=len_q)]
+         context, attn = self.attn(q_s, k_s, v_s, attn_mask)
+      else:
+         # fused FlashAttention / memory-efficient kernel, attention weights are never materialized
+         context = F.scaled_dot_product_attention(q_s, k_s, v_s, attn_mask=attn_mask, dropout_p=0.0, is_causal=False)
+         attn = None
+      # context: [batch_size x n_heads x len_q x d_v]
       context = context.transpose(1, 2).contiguous().view(batch_size, -1, n_heads * d_v) # context: [batch_size x len_q x n_heads * d_v]
-      output = nn.Linear(n_heads * d_v, d_model)(context)
+      output = self.proj(context)
 
-      return nn.LayerNorm(d_model)(output + residual), attn # output: [batch_size x len_q x d_model]
+      return self.ln(output + residual), attn # output: [batch_size x len_q x d_model]
 
 """Scaled Dot Product Attention
+By default MultiHeadAttention calls F.scaled_dot_product_attention, which lets PyTorch dispatch to a fused kernel. The module below is the eager reference version, used only when the attention weights are requested with need_weights=True.
 The scaled dot product attention class takes four arguments: Query, Key, Value, and Attention mask. Essentially, the first three arguments are fed with the word embeddings and the attention mask argument is fed with attention mask embeddings.
 Then it does a matrix multiplication between query and key to get scores. 
-Following that we use scores.masked_fill_(attn_mask, -1e9) . This attribute fills the element of scores with -1e9 where the attention masks are True while the rest of the elements get an attention score which is then passed through a softmax function that gives a score between 0 and 1. Finally, we perform a matrix multiplication between attention and values which gives us the context vectors.
+Following that we add the attention mask to the scores. It is an additive mask holding the lowest value of the activation dtype on [PAD] keys and 0 elsewhere, so the add and the softmax can fuse into one pass. The masked elements end up with zero weight while the rest of the elements get an attention score which is then passed through a softmax function that gives a score between 0 and 1. Finally, we perform a matrix multiplication between attention and values which gives us the context vectors.
 """
 
 class ScaledDotProductAttention(nn.Module):
    def __init__(self):
        super(ScaledDotProductAttention, self).__init__()
+       self.scale = float(d_k) ** -0.5
+       self.softmax = nn.Softmax(dim=-1)
 
    def forward(self, Q, K, V, attn_mask):
-       scores = torch.matmul(Q, K.transpose(-1, -2)) / np.sqrt(d_k) # scores : [batch_size x n_heads x len_q(=len_k) x len_k(=len_q)]
-       scores.masked_fill_(attn_mask, -1e9) # Fills elements of self tensor with value where mask is one.
-       attn = nn.Softmax(dim=-1)(scores)
+       # scaling Q before the matmul touches len_q x d_k elements instead of the len_q x len_k scores
+       scores = torch.matmul(Q * self.scale, K.transpose(-1, -2)) # scores : [batch_size x n_heads x len_q(=len_k) x len_k(=len_q)]
+       attn = self.softmax(scores.add_(attn_mask))
        context = torch.matmul(attn, V)
-       return score, context, attn
+       return context, attn
 
 """Position Wise Feed-Forward Layer"""
 
@@ -134,58 +147,67 @@ class PositionWiseFeedForward(nn.Module):
 
     def forward(self, x):
         # (batch_size, len_seq, d_model) -> (batch_size, len_seq, d_ff) -> (batch_size, len_seq, d_model)
-        return self.fc2(gelu(self.fc1(x)))
+        return self.fc2(F.gelu(self.fc1(x)))
+
+"""GeLU Activation
+The model calls F.gelu, which runs as a single fused kernel. The function below is the same exact (erf) GeLU written out in PyTorch ops, kept as a reference.
+"""
 
-"""GeLU Activation"""
+_INV_SQRT2 = 1.0 / math.sqrt(2.0)
 
 def gelu(x):
     "Implementation of the GeLU activation function"
-    return x * 0.5 * (1.0 + torch.erf(x / math.sqrt(2.0)))
+    return x * 0.5 * (1.0 + torch.erf(x * _INV_SQRT2))
 
 """Making Batches"""
 
 def make_batch():
-    batch = []
-    positive = negative = 0
-    while positive != batch_size/2 or negative != batch_size/2:
-        tokens_a_index, tokens_b_index= randrange(len(sentences)), randrange(len(sentences)) # sample random index in sentences
-        tokens_a, tokens_b= token_list[tokens_a_index], token_list[tokens_b_index]
-        input_ids = [word_dict['[CLS]']] + tokens_a + [word_dict['[SEP]']] + tokens_b + [word_dict['[SEP]']]
-        segment_ids = [0] * (1 + len(tokens_a) + 1) + [1] * (len(tokens_b) + 1)
+    rng = np.random.default_rng()
+    CLS, SEP, MASK = word_dict['[CLS]'], word_dict['[SEP]'], word_dict['[MASK]'] # loop invariants
+    input_ids = np.zeros((batch_size, maxlen), dtype=np.int64)
+    segment_ids = np.zeros((batch_size, maxlen), dtype=np.int64)
+    masked_tokens = np.zeros((batch_size, max_pred), dtype=np.int64)
+    masked_pos = np.zeros((batch_size, max_pred), dtype=np.int64)
+
+    # sample the sentence index pairs up front: half IsNext (b = a + 1), half NotNext
+    n_half = batch_size // 2
+    tokens_a_index = rng.integers(len(sentences), size=batch_size)
+    tokens_b_index = rng.integers(len(sentences), size=batch_size)
+    tokens_a_index[:n_half] = rng.integers(len(sentences) - 1, size=n_half)
+    tokens_b_index[:n_half] = tokens_a_index[:n_half] + 1
+    not_next = tokens_a_index[n_half:] + 1 == tokens_b_index[n_half:]
+    while not_next.any(): # only the index pair is resampled, nothing else has been built yet
+        tokens_b_index[n_half:][not_next] = rng.integers(len(sentences), size=not_next.sum())
+        not_next = tokens_a_index[n_half:] + 1 == tokens_b_index[n_half:]
+    is_next = (tokens_a_index + 1 == tokens_b_index).astype(np.int64) # IsNext / NotNext
+    order = rng.permutation(batch_size)
+    tokens_a_index, tokens_b_index, is_next = tokens_a_index[order], tokens_b_index[order], is_next[order]
+
+    longest = 0
+    for i in range(batch_size):
+        tokens_a, tokens_b= token_list[tokens_a_index[i]], token_list[tokens_b_index[i]]
+        tokens = np.array([CLS] + tokens_a + [SEP] + tokens_b + [SEP])
+        n_tokens, n_segment_a = len(tokens), 1 + len(tokens_a) + 1
+        longest = max(longest, n_tokens)
 
         # MASK LM
-        n_pred =  min(max_pred, max(1, int(round(len(input_ids) * 0.15)))) # 15 % of tokens in one sentence
-        cand_maked_pos = [i for i, token in enumerate(input_ids)
-                          if token != word_dict['[CLS]'] and token != word_dict['[SEP]']]
-        shuffle(cand_maked_pos)
-        masked_tokens, masked_pos = [], []
-        for pos in cand_maked_pos[:n_pred]:
-            masked_pos.append(pos)
-            masked_tokens.append(input_ids[pos])
-            if random() < 0.8:  # 80%
-                input_ids[pos] = word_dict['[MASK]'] # make mask
-            elif random() < 0.5:  # 10%
-                index = randint(0, vocab_size - 1) # random index in vocabulary
-                input_ids[pos] = word_dict[number_dict[index]] # replace
+        n_pred =  min(max_pred, max(1, int(round(n_tokens * 0.15)))) # 15 % of tokens in one sentence
+        cand_maked_pos = np.flatnonzero((tokens != CLS) & (tokens != SEP))
+        pos = rng.choice(cand_maked_pos, n_pred, replace=False)
+        masked_tokens[i, :n_pred] = tokens[pos] # the rest stays zero padding (100% - 15%)
+        masked_pos[i, :n_pred] = pos
+        p = rng.random(n_pred)
+        tokens[pos[p < 0.8]] = MASK # 80%, make mask
+        replace = pos[(p >= 0.8) & (p < 0.9)] # 10%, replace with a random index in vocabulary
+        tokens[replace] = rng.integers(vocab_size, size=len(replace))
 
         # Zero Paddings
-        n_pad = maxlen - len(input_ids)
-        input_ids.extend([0] * n_pad)
-        segment_ids.extend([0] * n_pad)
-
-        # Zero Padding (100% - 15%) tokens
-        if max_pred > n_pred:
-            n_pad = max_pred - n_pred
-            masked_tokens.extend([0] * n_pad)
-            masked_pos.extend([0] * n_pad)
-
-        if tokens_a_index + 1 == tokens_b_index and positive < batch_size/2:
-            batch.append([input_ids, segment_ids, masked_tokens, masked_pos, True]) # IsNext
-            positive += 1
-        elif tokens_a_index + 1 != tokens_b_index and negative < batch_size/2:
-            batch.append([input_ids, segment_ids, masked_tokens, masked_pos, False]) # NotNext
-            negative += 1
-    return batch
+        input_ids[i, :n_tokens] = tokens
+        segment_ids[i, n_segment_a:n_tokens] = 1
+    # drop the columns that are [PAD] in every row, but round up to a multiple of 8 (at most maxlen): the model is
+    # compiled with dynamic=False, so this keeps it to a few static shapes instead of recompiling for every length
+    seq_len = min(maxlen, -(-longest // 8) * 8)
+    return input_ids[:, :seq_len], segment_ids[:, :seq_len], masked_tokens, masked_pos, is_next
 
 """Model Class"""
 
@@ -197,22 +219,30 @@ class BERT(nn.Module):
       self.fc = nn.Linear(d_model, d_model)
       self.activ1 = nn.Tanh()
       self.linear = nn.Linear(d_model, d_model)
-      self.activ2 = gelu
+      self.activ2 = F.gelu
       self.norm = nn.LayerNorm(d_model)
       self.classifier = nn.Linear(d_model, 2)
       # decoder is shared with embedding layer
       embed_weight = self.embedding.token_embedding.weight
       n_vocab, n_dim = embed_weight.size()
-      self.decoder = nn.Linear(n_dim, n_vocab, bias=False)
+      # only the weight is tied, the bias lives in the Linear so matmul + bias run as one addmm
+      self.decoder = nn.Linear(n_dim, n_vocab, bias=True)
       self.decoder.weight = embed_weight
-      self.decoder_bias = nn.Parameter(torch.zeros(n_vocab))
+      nn.init.zeros_(self.decoder.bias)
 
-   def forward(self, input_ids, segment_ids, masked_pos):
+   def forward(self, input_ids, segment_ids, masked_pos, need_weights=False):
         output = self.embedding(input_ids, segment_ids)
-        enc_self_attn_mask = get_attn_pad_mask(input_ids, input_ids)
+        # shared by every layer, [batch_size x 1 x 1 x len_k] broadcasts over n_heads and len_q without a copy
+        pad_mask = get_attention_pad_mask(input_ids, input_ids)
+        # additive mask in the dtype the attention scores are computed in, finfo.min fits that dtype where -1e9 overflows fp16
+        device_type = input_ids.device.type
+        dtype = torch.get_autocast_dtype(device_type) if torch.is_autocast_enabled(device_type) else output.dtype
+        enc_self_attn_mask = torch.zeros_like(pad_mask, dtype=dtype).masked_fill_(pad_mask, torch.finfo(dtype).min)
+        enc_self_attns = []
         for layer in self.layers:
-            output, enc_self_attn = layer(output, enc_self_attn_mask)
-        # output : [batch_size, len, d_model], attn : [batch_size, n_heads, d_mode, d_model]
+            output, enc_self_attn = layer(output, enc_self_attn_mask, need_weights)
+            enc_self_attns.append(enc_self_attn)
+        # output : [batch_size, len, d_model], attn : [batch_size, n_heads, len_q, len_k], None unless need_weights
         # it will be decided by first token(CLS)
         h_pooled = self.activ1(self.fc(output[:, 0])) # [batch_size, d_model]
         logits_clsf = self.classifier(h_pooled) # [batch_size, 2]
@@ -221,8 +251,11 @@ class BERT(nn.Module):
         # get masked position from final output of transformer.
         h_masked = torch.gather(output, 1, masked_pos) # masking position [batch_size, max_pred, d_model]
         h_masked = self.norm(self.activ2(self.linear(h_masked)))
-        logits_lm = self.decoder(h_masked) + self.decoder_bias # [batch_size, max_pred, n_vocab]
+        logits_lm = self.decoder(h_masked) # [batch_size, max_pred, n_vocab]
 
+        if need_weights:
+            # per-layer attention weights from the eager ScaledDotProductAttention path
+            return logits_lm, logits_clsf, enc_self_attns
         return logits_lm, logits_clsf
 
 if __name__ == '__main__':
@@ -258,7 +291,10 @@ if __name__ == '__main__':
         arr = [word_dict[s] for s in sentence.split()]
         token_list.append(arr)
 
-    model = BERT()
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    bert = BERT().to(device)
+    # maxlen, batch_size and max_pred are fixed, so specialize on static shapes
+    model = torch.compile(bert, mode="reduce-overhead", dynamic=False)
 
 """Training"""
 
@@ -266,31 +302,45 @@ criterion = nn.CrossEntropyLoss()
 optimizer = optim.Adam(model.parameters(), lr=0.001)
 
 batch = make_batch()
-input_ids, segment_ids, masked_tokens, masked_pos, isNext = map(torch.LongTensor, zip(*batch))
+# pinned host memory lets the copy to the GPU overlap with kernel launches
+pin = device.type == "cuda"
+input_ids, segment_ids, masked_tokens, masked_pos, isNext = (
+    (torch.from_numpy(t).pin_memory() if pin else torch.from_numpy(t)).to(device, non_blocking=True) for t in batch)
 
+# the first steps compile the model and record the CUDA graphs, the remaining ones replay them
 for epoch in range(100):
+    # every iteration is a new step, so the graph outputs of the previous one may be overwritten
+    torch.compiler.cudagraph_mark_step_begin()
     optimizer.zero_grad()
-    logits_lm, logits_clsf = model(input_ids, segment_ids, masked_pos)
-    loss_lm = criterion(logits_lm.transpose(1, 2), masked_tokens) # for masked LM
-    loss_lm = (loss_lm.float()).mean()
-    loss_clsf = criterion(logits_clsf, isNext) # for sentence classification
-    loss = loss_lm + loss_clsf
+    # bf16 mixed precision for the GEMMs, autocast keeps softmax/LayerNorm/loss in fp32 and the optimizer stays fp32
+    with torch.autocast(device_type=input_ids.device.type, dtype=torch.bfloat16):
+        logits_lm, logits_clsf = model(input_ids, segment_ids, masked_pos)
+        loss_lm = criterion(logits_lm.transpose(1, 2), masked_tokens) # for masked LM
+        loss_lm = (loss_lm.float()).mean()
+        loss_clsf = criterion(logits_clsf, isNext) # for sentence classification
+        loss = loss_lm + loss_clsf
     if (epoch + 1) % 10 == 0:
          print('Epoch:', '%04d' % (epoch + 1), 'cost =', '{:.6f}'.format(loss))
     loss.backward()
     optimizer.step()
 
+# int8 dynamic quantization of the Linears for CPU inference. This runs fully in eager mode (nothing inside the
+# model is compiled on its own): on CPU torch.compile falls back to fp32 for the int8 Linears and ends up slower.
+# Quantize a CPU copy so the trained bert, and the compiled model sharing its parameters, stay on their device
+q_model = tq.quantize_dynamic(copy.deepcopy(bert).cpu().eval(), {nn.Linear}, dtype=torch.qint8)
+
 # Predict mask tokens ans isNext
-input_ids, segment_ids, masked_tokens, masked_pos, isNext = map(torch.LongTensor, zip(batch[0]))
+input_ids, segment_ids, masked_tokens, masked_pos, isNext = (torch.from_numpy(t[:1]) for t in batch)
 print(text)
 print([number_dict[w.item()] for w in input_ids[0] if number_dict[w.item()] != '[PAD]'])
 
-logits_lm, logits_clsf = model(input_ids, segment_ids, masked_pos)
-logits_lm = logits_lm.data.max(2)[1][0].data.numpy()
+with torch.no_grad():
+    logits_lm, logits_clsf = q_model(input_ids, segment_ids, masked_pos)
+logits_lm = logits_lm.data.max(2)[1][0].data.cpu().numpy()
 print('masked tokens list : ',[pos.item() for pos in masked_tokens[0] if pos.item() != 0])
 print('predict masked tokens list : ',[pos for pos in logits_lm if pos != 0])
 
-logits_clsf = logits_clsf.data.max(1)[1].data.numpy()[0]
+logits_clsf = logits_clsf.data.max(1)[1].data.cpu().numpy()[0]
 print('isNext : ', True if isNext else False)
 
 print('isNext : ', True if isNext else False)